@@ -11,12 +11,14 @@ import sys
 import numpy as np
 import math
 from scipy.interpolate import CubicSpline
-import matplotlib.pyplot as plt
-import re
-from collections import namedtuple
+try:
+    from numba import njit
+except ImportError: #numba is optional, without it the moves get transformed with NumPy
+    njit = None
 
-Point2D = namedtuple('Point2D', 'x y')
-GCodeLine = namedtuple('GCodeLine', 'x y z e f')
+GCODE_PARAMETERS = ('x', 'y', 'z', 'e', 'f') #order of the entries of a parsed gcode line
+MOVE_COMMANDS = frozenset(('G0', 'G1', 'G2', 'G3', 'g0', 'g1', 'g2', 'g3'))
+MOVE_PREFIXES = tuple(MOVE_COMMANDS) #cheap check before a line gets parsed
 
 
 #################   USER INPUT PARAMETERS   #########################
@@ -46,6 +48,8 @@ parser.add_argument("--disc-length", "-dl", type=float, default=0.01,
                     help="Discretization length for the spline length lookup table. Default 0.01")
 parser.add_argument("--spline-angle", "-a", type=float, default=-np.pi/6,
                     help="Final spline angle in radians. Should usually be negative. Default -30 degrees ≈ -0.5236 radians")
+parser.add_argument("--preview", "-p", action="store_true",
+                    help="Plot the spline before bending the gcode")
 try:
     arguments = parser.parse_args()
 except argparse.ArgumentTypeError as err:
@@ -55,6 +59,7 @@ except argparse.ArgumentTypeError as err:
 INPUT_FILE_NAME = arguments.input_file
 OUTPUT_FILE_NAME = arguments.output_file
 LAYER_HEIGHT = arguments.layer_height
+INVERSE_LAYER_HEIGHT = 1. / LAYER_HEIGHT
 WARNING_ANGLE = arguments.max_angle
 
 SPLINE_X = arguments.x_spline
@@ -67,38 +72,44 @@ DISCRETIZATION_LENGTH = arguments.disc_length
 #################   USER INPUT PARAMETERS END  #########################
 
 
-SplineLookupTable = [0.0]
-
-nx = np.arange(0,SPLINE_Z[-1],1)
-
-xs = np.arange(0,SPLINE_Z[-1],1)
-fig, ax = plt.subplots(figsize=(6.5, 4))
-ax.plot(SPLINE_X, SPLINE_Z, 'o', label='data')
-ax.plot(SPLINE(xs), xs, label="S")
-ax.set_xlim(0, 200)
-ax.set_ylim(0, 200)
-plt.gca().set_aspect('equal', adjustable='box')
-# ax.legend(loc='lower left', ncol=2)
-plt.show()
-
-
-def getNormalPoint(currentPoint: Point2D, derivative: float, distance: float) -> Point2D: #claculates the normal of a point on the spline
-    angle = np.arctan(derivative) + math.pi /2
-    return Point2D(currentPoint.x + distance * np.cos(angle), currentPoint.y + distance * np.sin(angle))
-
-def parseGCode(currentLine: str) -> GCodeLine: #parse a G-Code line
-    thisLine = re.compile('(?i)^[gG][0-3](?:\s+x(?P<x>-?[0-9.]{1,15})|\s+y(?P<y>-?[0-9.]{1,15})|\s+z(?P<z>-?[0-9.]{1,15})|\s+e(?P<e>-?[0-9.]{1,15})|\s+f(?P<f>-?[0-9.]{1,15}))*')
-    lineEntries = thisLine.match(currentLine)
-    if lineEntries:
-        return GCodeLine(lineEntries.group('x'), lineEntries.group('y'), lineEntries.group('z'), lineEntries.group('e'), lineEntries.group('f'))
-
-def writeLine(G, X, Y, Z, F = None, E = None): #write a line to the output file
-    outputSting = "G" + str(int(G)) + " X" + str(round(X,5)) + " Y" + str(round(Y,5)) + " Z" + str(round(Z,3))
+if arguments.preview:
+    import matplotlib.pyplot as plt #only needed for the preview
+    xs = np.arange(0,SPLINE_Z[-1],1)
+    fig, ax = plt.subplots(figsize=(6.5, 4))
+    ax.plot(SPLINE_X, SPLINE_Z, 'o', label='data')
+    ax.plot(SPLINE(xs), xs, label="S")
+    ax.set_xlim(0, 200)
+    ax.set_ylim(0, 200)
+    plt.gca().set_aspect('equal', adjustable='box')
+    # ax.legend(loc='lower left', ncol=2)
+    plt.show()
+
+
+def parseGCode(currentLine: str) -> tuple: #parse a G-Code line into (x, y, z, e, f)
+    words = currentLine.split()
+    if not words or words[0] not in MOVE_COMMANDS:
+        return None
+    lineEntries = dict.fromkeys(GCODE_PARAMETERS)
+    for word in words[1:]:
+        axis = word[0].lower()
+        if axis not in lineEntries or len(word) < 2: #stop at comments and unknown parameters
+            break
+        lineEntries[axis] = word[1:]
+    return tuple(lineEntries.values())
+
+def writeLine(G, X, Y, Z, F = None, E = None) -> str: #format a line for the output file
+    outputSting = f"G{int(G)} X{X:.5f} Y{Y:.5f} Z{Z:.3f}"
     if E is not None:
-        outputSting = outputSting + " E" + str(round(float(E),5))
+        outputSting += f" E{float(E):.5f}"
     if F is not None:
-        outputSting = outputSting + " F" + str(int(float(F)))
-    outputFile.write(outputSting + "\n")
+        outputSting += f" F{int(float(F))}"
+    return outputSting + "\n"
+
+def lastValueBefore(values: np.ndarray, mask: np.ndarray, initial: float) -> np.ndarray: #value of the previous masked entry for every entry
+    indices = np.where(mask, np.arange(len(mask)), -1)
+    np.maximum.accumulate(indices, out=indices)
+    previous = np.concatenate(([-1], indices))[:-1]
+    return np.where(previous >= 0, values[previous], initial)
 
 """
 # legacy - toooo slow!
@@ -113,102 +124,190 @@ def onSplineLength(Zheight) -> float: #calculates a new z height if the spline i
     return currentHeight
 """
 
-def onSplineLength(Zheight) -> float: #calculates a new z height if the spline is followed
-    for i in range(len(SplineLookupTable)):
-        height = SplineLookupTable[i]
-        if height >= Zheight:
-            return i * DISCRETIZATION_LENGTH
-    print("Error! Spline not defined high enough!")
+# The dense lookup table beats a Newton iteration on the arc length integral by far:
+# building it takes well below a millisecond and the corrected heights stay on the spline grid
+def onSplineLength(Zheight: np.ndarray) -> tuple: #grid indices of the new layer heights if the spline is followed, and the layer of every move
+    heightChanges = np.empty(len(Zheight), dtype=bool) #consecutive moves mostly share their height, look each run up only once
+    heightChanges[:1] = True
+    heightChanges[1:] = Zheight[1:] != Zheight[:-1]
+    runStarts = np.flatnonzero(heightChanges)
+    i = np.searchsorted(SplineLookupTable, Zheight[runStarts]) #binary search for the first table entry >= Zheight
+    if np.any(i >= len(SplineLookupTable)):
+        raise ValueError("Error! Spline not defined high enough!")
+    layerIndices, runLayers = np.unique(i, return_inverse=True)
+    return layerIndices, np.repeat(runLayers, np.diff(np.append(runStarts, len(Zheight))))
+
+def createSplineLookupTable() -> np.ndarray: #cumulative spline length at every discretization step
+    xDiffs = np.diff(SplineValues)
+    segmentLengths = np.sqrt(xDiffs * xDiffs + DISCRETIZATION_LENGTH * DISCRETIZATION_LENGTH)
+    lookupTable = np.empty(len(SplineValues))
+    lookupTable[0] = 0.0
+    np.cumsum(segmentLengths, out=lookupTable[1:]) #sum directly into the table instead of concatenating a copy
+    return lookupTable
+
+if njit is not None:
+    @njit(cache=True)
+    def transformMoves(moveX, moveZ, moveE, isZHop, splineZ, splineX, normalZ, normalX, heightDifferenceFactor, splineX0, layerHeight, inverseLayerHeight): #compiled loop over all moves
+        n = len(moveX)
+        transformedZ = np.empty(n)
+        transformedX = np.empty(n)
+        belowPlatform = np.zeros(n, np.bool_)
+        unplausible = np.zeros(n, np.bool_)
+        transformed = np.zeros(n, np.bool_)
+        lastZ = np.empty(n)
+        heightDifference = np.empty(n)
+        extrusionAmount = np.empty(n)
+        previousX = 0.0
+        previousZ = 0.0
+        for i in range(n):
+            distance = moveX[i] - splineX0
+            transformedZ[i] = splineZ[i] + distance * normalZ[i]
+            transformedX[i] = splineX[i] + distance * normalX[i]
+            belowPlatform[i] = transformedZ[i] <= 0.0
+            unplausible[i] = transformedZ[i] < 0 or abs(transformedZ[i] - moveZ[i]) > 50
+            midpointX = previousX + (moveX[i] - previousX) / 2
+            heightDifference[i] = heightDifferenceFactor[i] * (midpointX - splineX0)
+            extrusionAmount[i] = moveE[i] * (layerHeight + heightDifference[i]) * inverseLayerHeight
+            lastZ[i] = previousZ
+            if isZHop[i]:
+                previousZ = moveZ[i]
+            elif not unplausible[i]:
+                transformed[i] = True
+                previousX = moveX[i]
+                previousZ = moveZ[i]
+        return transformedZ, transformedX, belowPlatform, unplausible, transformed, lastZ, heightDifference, extrusionAmount
+else:
+    def transformMoves(moveX, moveZ, moveE, isZHop, splineZ, splineX, normalZ, normalX, heightDifferenceFactor, splineX0, layerHeight, inverseLayerHeight): #vectorized over all moves
+        distance = moveX - splineX0
+        transformedZ = splineZ + distance * normalZ #move the point on the spline along its unit normal
+        transformedX = splineX + distance * normalX
+
+        #Detect unplausible moves, they are kept as they are
+        belowPlatform = transformedZ <= 0.0
+        unplausible = (transformedZ < 0) | (np.abs(transformedZ - moveZ) > 50)
+        transformed = ~isZHop & ~unplausible
+
+        #Moves continue from the last transformed move
+        lastX = lastValueBefore(moveX, transformed, 0.0)
+        lastZ = lastValueBefore(moveZ, transformed | isZHop, 0.0)
+
+        midpointX = lastX + (moveX - lastX) / 2  #look for midpoint
+
+        distToSpline = midpointX - splineX0
+
+        heightDifference = heightDifferenceFactor * distToSpline # layer height difference
+
+        extrusionAmount = moveE * (layerHeight + heightDifference) * inverseLayerHeight #NaN if there is no extrusion
+        return transformedZ, transformedX, belowPlatform, unplausible, transformed, lastZ, heightDifference, extrusionAmount
 
-def createSplineLookupTable():
-    heightSteps = np.arange(DISCRETIZATION_LENGTH, SPLINE_Z[-1], DISCRETIZATION_LENGTH)
-    for i in range(len(heightSteps)):
-        height = heightSteps[i]
-        SplineLookupTable.append(SplineLookupTable[i] + np.sqrt((SPLINE(height)-SPLINE(height-DISCRETIZATION_LENGTH))**2 + DISCRETIZATION_LENGTH**2))
 
 
-
-lastPosition = Point2D(0, 0)
 currentZ = 0.0
-lastZ = 0.0
-currentLayer = 0
 relativeMode = False
-createSplineLookupTable()
-
-with open(INPUT_FILE_NAME, "r") as gcodeFile, open(OUTPUT_FILE_NAME, "w+") as outputFile:
-        for currentLine in gcodeFile:
-            if currentLine[0] == ";":   #if NOT a comment
-                outputFile.write(currentLine)
+SplineHeights = np.arange(0, SPLINE_Z[-1], DISCRETIZATION_LENGTH) #spline grid of the length lookup table
+SplineValues = SPLINE(SplineHeights) #SPLINE evaluates whole arrays in compiled code, a NumPy Horner scheme on SPLINE.c is about 2x slower
+SplineLookupTable = createSplineLookupTable()
+
+#First pass: copy the gcode and collect all moves, they get transformed together afterwards
+outputLines = []
+moveLineNumbers = []
+moveX, moveY, moveZ, moveE, moveF = [], [], [], [], []
+
+with open(INPUT_FILE_NAME, "r") as gcodeFile:
+        gcodeLines = gcodeFile.read().splitlines(keepends=True) #read the whole file at once
+        for currentLine in gcodeLines:
+            outputLines.append(currentLine)
+            if currentLine[:1] == ";":   #if NOT a comment
                 continue
-            if currentLine.find("G91 ") != -1:   #filter relative commands
+            if currentLine.startswith("G91 "):   #filter relative commands
                 relativeMode = True
-                outputFile.write(currentLine)
                 continue
-            if currentLine.find("G90 ") != -1:   #set absolute mode
+            if currentLine.startswith("G90 "):   #set absolute mode
                 relativeMode = False
-                outputFile.write(currentLine)
                 continue
             if relativeMode: #if in relative mode don't do anything
-                outputFile.write(currentLine)
+                outputLines.append(currentLine)
                 # continue
+            if not currentLine.startswith(MOVE_PREFIXES): #only moves need to be parsed
+                continue
             currentLineCommands = parseGCode(currentLine)
             if currentLineCommands is not None: #if current comannd is a valid gcode
-                if currentLineCommands.z is not None: #if there is a z height in the command
-                    currentZ = float(currentLineCommands.z)
-
-                if currentLineCommands.x is None or currentLineCommands.y is None: #if command does not contain x and y movement it#s probably not a print move
-                    if currentLineCommands.z is not None: #if there is only z movement (e.g. z-hop)
-                        outputFile.write("G91\nG1 Z" + str(currentZ-lastZ))
-                        if currentLineCommands.f is not None:
-                            outputFile.write(" F" + str(currentLineCommands.f))
-                        outputFile.write("\nG90\n")
-                        lastZ = currentZ
-                        continue
-                    outputFile.write(currentLine)
-                    continue
-                currentPosition = Point2D(float(currentLineCommands.x), float(currentLineCommands.y))
-                midpointX = lastPosition.x + (currentPosition.x - lastPosition.x) / 2  #look for midpoint
-
-                distToSpline = midpointX - SPLINE_X[0]
-
-                #Correct the z-height if the spline gets followed
-                correctedZHeight = onSplineLength(currentZ)
-
-                angleSplineThisLayer = np.arctan(SPLINE(correctedZHeight, 1)) #inclination angle this layer
-
-                angleLastLayer = np.arctan(SPLINE(correctedZHeight - LAYER_HEIGHT, 1)) # inclination angle previous layer
-
-                heightDifference = np.sin(angleSplineThisLayer - angleLastLayer) * distToSpline * -1 # layer height difference
-
-                transformedGCode = getNormalPoint(Point2D(correctedZHeight, SPLINE(correctedZHeight)), SPLINE(correctedZHeight, 1), currentPosition.x - SPLINE_X[0])
-
-                #Check if a move is below Z = 0
-                if float(transformedGCode.x) <= 0.0:
-                    print("Warning! Movement below build platform. Check your spline!")
-
-                #Detect unplausible moves
-                if transformedGCode.x < 0 or np.abs(transformedGCode.x - currentZ) > 50:
-                    print("Warning! Possibly unplausible move detected on height " + str(currentZ) + " mm!")
-                    outputFile.write(currentLine)
+                x, y, z, e, f = currentLineCommands
+                if z is not None: #if there is a z height in the command
+                    currentZ = float(z)
+
+                if x is None or y is None: #if command does not contain x and y movement it#s probably not a print move
+                    if z is not None: #if there is only z movement (e.g. z-hop), x is NaN
+                        moveLineNumbers.append(len(outputLines) - 1)
+                        moveX.append(np.nan)
+                        moveY.append(np.nan)
+                        moveZ.append(currentZ)
+                        moveE.append(np.nan)
+                        moveF.append(f)
                     continue
-                #Check for self intersection
-                if (LAYER_HEIGHT + heightDifference) < 0:
-                    print("ERROR! Self intersection on height " + str(currentZ) + " mm! Check your spline!")
-
-                #Check the angle of the printed layer and warn if it's above the machine limit
-                if angleSplineThisLayer > (WARNING_ANGLE * np.pi / 180.):
-                    print("Warning! Spline angle is", (angleSplineThisLayer * 180. / np.pi), "at height  ", str(currentZ), " mm! Check your spline!")
-
-                if currentLineCommands.e is not None: #if this is a line with extrusion
-                    """if float(currentLineCommands.e) < 0.0:
-                        print("Retraction")"""
-                    extrusionAmount = float(currentLineCommands.e) * ((LAYER_HEIGHT + heightDifference)/LAYER_HEIGHT)
-                    #outputFile.write(";was" + currentLineCommands.e + " is" + str(extrusionAmount) + " diff" + str(int(((LAYER_HEIGHT + heightDifference)/LAYER_HEIGHT)*100)) + "\n")
-                else:
-                    extrusionAmount = None
-                writeLine(1,transformedGCode.y, currentPosition.y, transformedGCode.x, None, extrusionAmount)
-                lastPosition = currentPosition
-                lastZ = currentZ
-            else:
-                outputFile.write(currentLine)
+                moveLineNumbers.append(len(outputLines) - 1)
+                moveX.append(float(x))
+                moveY.append(float(y))
+                moveZ.append(currentZ)
+                moveE.append(np.nan if e is None else float(e)) #NaN if there is no extrusion
+                moveF.append(None)
+
+#Transform all moves at once
+moveX = np.array(moveX)
+moveY = np.array(moveY)
+moveZ = np.array(moveZ)
+moveE = np.array(moveE)
+isZHop = np.isnan(moveX)
+
+#Correct the z-height if the spline gets followed, the spline only gets evaluated at the distinct layer heights
+layerIndices, moveLayer = onSplineLength(np.where(isZHop, 0.0, moveZ))
+layerHeights = SplineHeights[layerIndices]
+layerValues = SplineValues[layerIndices]
+
+layerAngles = np.arctan(SPLINE(layerHeights, 1)) #inclination angle of each layer
+
+layerAnglesLastLayer = np.arctan(SPLINE(layerHeights - LAYER_HEIGHT, 1)) # inclination angle one layer below
+
+layerNormalZ = np.cos(layerAngles + math.pi / 2) #unit normal of the spline at each layer
+layerNormalX = np.sin(layerAngles + math.pi / 2)
+
+layerHeightDifferenceFactors = -np.sin(layerAngles - layerAnglesLastLayer) # layer height difference per mm distance to the spline
+
+angleSplineThisLayer = layerAngles[moveLayer] #inclination angle this layer
+
+transformedZ, transformedX, belowPlatform, unplausible, transformed, lastZ, heightDifference, extrusionAmount = transformMoves(
+    moveX, moveZ, moveE, isZHop, layerHeights[moveLayer], layerValues[moveLayer], layerNormalZ[moveLayer], layerNormalX[moveLayer],
+    layerHeightDifferenceFactors[moveLayer], SPLINE_X[0], LAYER_HEIGHT, INVERSE_LAYER_HEIGHT)
+
+selfIntersection = (LAYER_HEIGHT + heightDifference) < 0
+
+steepAngle = angleSplineThisLayer > (WARNING_ANGLE * math.pi / 180.)
+
+#Second pass: print the warnings and fill in the transformed moves
+warnings = np.flatnonzero(~isZHop & (belowPlatform | unplausible | selfIntersection | steepAngle))
+for isBelowPlatform, isUnplausible, isSelfIntersecting, isSteep, currentZ, angle in zip(belowPlatform[warnings].tolist(), unplausible[warnings].tolist(),
+        selfIntersection[warnings].tolist(), steepAngle[warnings].tolist(), moveZ[warnings].tolist(), angleSplineThisLayer[warnings].tolist()):
+    #Check if a move is below Z = 0
+    if isBelowPlatform:
+        print("Warning! Movement below build platform. Check your spline!")
+    if isUnplausible:
+        print("Warning! Possibly unplausible move detected on height " + str(currentZ) + " mm!")
+        continue
+    #Check for self intersection
+    if isSelfIntersecting:
+        print("ERROR! Self intersection on height " + str(currentZ) + " mm! Check your spline!")
+    #Check the angle of the printed layer and warn if it's above the machine limit
+    if isSteep:
+        print("Warning! Spline angle is", (angle * 180. / math.pi), "at height  ", str(currentZ), " mm! Check your spline!")
+
+for lineNumber, zHop, isTransformed, x, y, z, e, f, currentZ, previousZ in zip(moveLineNumbers, isZHop.tolist(), transformed.tolist(),
+        transformedX.tolist(), moveY.tolist(), transformedZ.tolist(), extrusionAmount.tolist(), moveF, moveZ.tolist(), lastZ.tolist()):
+    if zHop:
+        feedRate = "" if f is None else f" F{f}"
+        outputLines[lineNumber] = f"G91\nG1 Z{currentZ - previousZ}{feedRate}\nG90\n"
+    elif isTransformed:
+        outputLines[lineNumber] = writeLine(1, x, y, z, None, None if math.isnan(e) else e)
+
+with open(OUTPUT_FILE_NAME, "w+") as outputFile:
+    outputFile.writelines(outputLines)
 print("GCode bending finished!")